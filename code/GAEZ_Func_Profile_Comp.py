@@ -10,6 +10,7 @@ import colour
 import math
 from math import radians, cos, sin, asin, sqrt
 import json
+import threading, queue
 
 import numpy as np
 import pandas as pd
@@ -21,16 +22,19 @@ from scipy.interpolate import CubicSpline
 from sklearn.utils import validation
 from sklearn.metrics import pairwise
 from sklearn.metrics.pairwise import euclidean_distances
+from sklearn.neighbors import KDTree, BallTree
 from scipy.sparse import issparse
 
 from pandas.io.json import json_normalize
-#from skimage import color
+from skimage import color
 from collections import OrderedDict
 from collections import Counter
 import MySQLdb
+import MySQLdb.cursors
 import io
+import pyarrow as pa
 
-from osgeo import gdal, ogr
+from osgeo import gdal, ogr, osr
 from osgeo.gdalconst import *
 import geopandas as gpd
 import shapely
@@ -196,9 +200,64 @@ def getGAEZ_drainage_req(CROP_ID, Input_Level_List):
 #     finally:
 #         conn.close()  
   
+# Depth weights adjusted to reflect LPKS depths. Assume max depth of 70 cm and depths 0-1,1-10,10-20,20-50,50-70, gives equal weight to 0-20 cm depths
+# Returns None when there are no weights for the number of layers
+def getGAEZ_depth_wts(depths, depthWt_type=1):
+    if depthWt_type == 1:
+        if depths == 5:
+            wts = [0.125, 1.125, 1.25, 1.66, 0.84]
+        elif depths ==4:
+            wts = [0.15, 1.10, 1.25, 1.5]
+        elif depths ==3:
+            wts = [.15, 1.35, 1.5]
+        elif depths ==2:
+            wts = [.02, 1.8]
+        elif depths ==1:
+            wts = [1]
+        else:
+            wts = None
+    elif depthWt_type == 2:
+        if depths == 5:
+            wts = [0.2, 1.8, 2, 0.67, 0.33]
+        elif depths ==4:
+            wts = [0.16, 1.44, 1.6, 0.8]
+        elif depths ==3:
+            wts = [.15, 1.35, 1.5]
+        elif depths ==2:
+            wts = [.02, 1.8]
+        elif depths ==1:
+            wts = [1]
+        else:
+            wts = None
+    else:
+        wts = None
+    return wts
+
+# GAEZ input_level codes of an input level ('L', 'I' or 'H'); None for an unknown input level
+def getInput_Level_List(inputLevel):
+    if inputLevel == 'L':
+        Input_Level_List = ['1','3', '4']
+    elif inputLevel == 'I':
+        Input_Level_List = ['2','3', '4']
+    elif inputLevel == 'H':
+        Input_Level_List = ['4','5']
+    else:
+        Input_Level_List = None
+    return Input_Level_List
+
+# Crop and input specific requirement tables used by the SQI scoring. When scoring many profiles, fetch them
+# once and pass them as `requirements` instead of querying the database for every profile.
+def getGAEZ_requirements(CROP_ID, inputLevel):
+    Input_Level_List = getInput_Level_List(inputLevel)
+    if Input_Level_List is None:
+        return None
+    return {'texture': getGAEZ_texture_req(CROP_ID, Input_Level_List), 'property': getGAEZ_profile_req(CROP_ID, Input_Level_List),
+            'phase': getGAEZ_phase_req(CROP_ID, Input_Level_List), 'drainage': getGAEZ_drainage_req(CROP_ID, Input_Level_List)}
+
 # -----------------------------------------------------------------------------------------------------
 #Function to GAEZ Soil Quality Indides
-def func_prof_comp_GAEZ_SQI(data, CROP_ID, inputLevel, depthWt_type=1):
+# Returns (SQ1, SQ2, SQ3, SQ7, SR) for one profile, or a message if the profile cannot be scored
+def getGAEZ_SQI_scores(data, CROP_ID, inputLevel, depthWt_type=1, requirements=None):
 #     data = getWISE30sec_comp_data(COMPID)
 # 
 # ## ---------------------------------------------------------------------------------------------------------------------
@@ -659,13 +718,8 @@ def func_prof_comp_GAEZ_SQI(data, CROP_ID, inputLevel, depthWt_type=1):
   # N  Not suitable (<10%)
   
   # determine possible input_level codes
-    if inputLevel == 'L':
-        Input_Level_List = ['1','3', '4']
-    elif inputLevel == 'I':
-        Input_Level_List = ['2','3', '4']
-    elif inputLevel == 'H':
-        Input_Level_List = ['4','5']
-    else:
+    Input_Level_List = getInput_Level_List(inputLevel)
+    if Input_Level_List is None:
         return 'Please enter `inputLevel`'
         
   # Standard GAEZ depth weights:
@@ -677,44 +731,23 @@ def func_prof_comp_GAEZ_SQI(data, CROP_ID, inputLevel, depthWt_type=1):
   # 40     |      2        | 1.25, .75
   # 20     |      1        | 1
 
-# depth weights adjusted to reflect LPKS depths. Assume max depth of 70 cm and depths 0-1,1-10,10-20,20-50,50-70, gives equal weight to 0-20 cm depths
-    if depthWt_type == 1:
-        if depths == 5:
-            wts = [0.125, 1.125, 1.25, 1.66, 0.84]
-        elif depths ==4:
-            wts = [0.15, 1.10, 1.25, 1.5]
-        elif depths ==3:
-            wts = [.15, 1.35, 1.5]
-        elif depths ==2:
-            wts = [.02, 1.8]
-        elif depths ==1:
-            wts = [1]
-        else:
-            return 'Input data missing'
-    elif depthWt_type == 2:   
-        if depths == 5:
-            wts = [0.2, 1.8, 2, 0.67, 0.33]
-        elif depths ==4:
-            wts = [0.16, 1.44, 1.6, 0.8]
-        elif depths ==3:
-            wts = [.15, 1.35, 1.5]
-        elif depths ==2:
-            wts = [.02, 1.8]
-        elif depths ==1:
-            wts = [1]
-        else:
-            return 'Input data missing'          
-          
-          
+# depth weights adjusted to reflect LPKS depths (see getGAEZ_depth_wts)
+    wts = getGAEZ_depth_wts(depths, depthWt_type)
+    if wts is None:
+        return 'Input data missing'
+
+
   # Load in crop and input specific property requirements
+    if requirements is None:
+        requirements = getGAEZ_requirements(CROP_ID, inputLevel)
     #Texture requirements based on crop and input level
-    texture_req = getGAEZ_texture_req(CROP_ID, Input_Level_List)
+    texture_req = requirements['texture']
     #Property requirements based on crop and input level
-    property_req = getGAEZ_profile_req(CROP_ID, Input_Level_List)
+    property_req = requirements['property']
     #Phase requirements based on crop and input level
-    phase_req = getGAEZ_phase_req(CROP_ID, Input_Level_List)    
+    phase_req = requirements['phase']
     #Drainage requirements based on crop and input level
-    drainage_req = getGAEZ_drainage_req(CROP_ID, Input_Level_List)    
+    drainage_req = requirements['drainage']
 
   # SQI 1: Soil fertility
     if inputLevel == 'H':
@@ -843,6 +876,1264 @@ def func_prof_comp_GAEZ_SQI(data, CROP_ID, inputLevel, depthWt_type=1):
         SR = SQ1_score * (SQ3_score/100) * (SQ7_score/100)
     elif inputLevel == 'H':
         SR = SQ2_score * (SQ3_score/100) * (SQ7_score/100)
+    return SQ1_score, SQ2_score, SQ3_score, SQ7_score, SR
+
+# GAEZ Soil Quality Indices of one profile as a one-row DataFrame
+def func_prof_comp_GAEZ_SQI(data, CROP_ID, inputLevel, depthWt_type=1, requirements=None):
+    scores = getGAEZ_SQI_scores(data, CROP_ID, inputLevel, depthWt_type, requirements)
+    if isinstance(scores, str):
+        return scores
+    SQ1_score, SQ2_score, SQ3_score, SQ7_score, SR = scores
     SQI_scores = pd.DataFrame(data={'SQ1': [SQ1_score],'SQ2': [SQ2_score],'SQ3': [SQ3_score], 'SQ7': [SQ7_score], 'SR': [SR], 'Input Level': inputLevel, 'id': data.id[0]})
-    return(SQI_scores)    
+    return(SQI_scores)
+
+#####################################################################################################
+#                                       streaming pipeline                                          #
+#####################################################################################################
+# Profiles are streamed through func_prof_comp_GAEZ_SQI in chunks of whole profiles:
+#   read -> harmonize -> score -> write
+# Each stage runs on its own thread(s) and is connected to the next by a bounded queue, so a slow writer
+# blocks the scorers and a slow scorer blocks the reader (backpressure). Memory use is bounded by
+# queue_size * chunk_size profiles rather than by the size of the dataset. Every chunk that has been
+# written is recorded in a checkpoint file so that an interrupted run resumes at the last finished chunk.
+
+# LPKS depth intervals (bottom depth, cm) that the depthWt_type weights in func_prof_comp_GAEZ_SQI assume
+LPKS_depths = [1, 10, 20, 50, 70]
+
+# Stream WISE30sec component layers for a set of map units using a server-side cursor.
+# Yields DataFrames holding `chunk_size` complete components (layers of a component are never split).
+def getWISE30sec_comp_stream(MUGLB_NEW_Select, chunk_size=500, fetch_size=10000):
+    columns = ['MUGLB_NEW', 'COMPID', 'PROP', 'Layer', 'TopDep', 'BotDep', 'CFRAG', 'text_class', 'text_class_id', 'REF_DEPTH']
+    conn = getDataStore_Connection()
+    try:
+        cur = conn.cursor(MySQLdb.cursors.SSCursor)
+        sql = 'SELECT ' + ', '.join(columns) + ' FROM  wise_soil_data WHERE MUGLB_NEW IN (' + ','.join(map(str, MUGLB_NEW_Select)) + ') ORDER BY COMPID, TopDep'
+        cur.execute(sql)
+        rows = []
+        n_comp = 0
+        last_comp = None
+        while True:
+            results = cur.fetchmany(fetch_size)
+            if not results:
+                break
+            for row in results:
+                if row[1] != last_comp:
+                    if n_comp == chunk_size:
+                        yield pd.DataFrame(rows, columns=columns)
+                        rows = []
+                        n_comp = 0
+                    last_comp = row[1]
+                    n_comp = n_comp + 1
+                rows.append(row)
+        if rows:
+            yield pd.DataFrame(rows, columns=columns)
+    finally:
+        conn.close()
+
+# Split an in-memory table of profile layers (e.g. LPKS_Soil_Map_Data passed from R) into chunks of
+# `chunk_size` complete profiles
+def iter_profile_chunks(data, chunk_size=500, id_col='id'):
+    codes, ids = pd.factorize(data[id_col])
+    order = np.argsort(codes, kind='stable')
+    bounds = np.searchsorted(codes[order], np.arange(0, len(ids) + chunk_size, chunk_size))
+    for i in range(len(bounds) - 1):
+        if bounds[i] < bounds[i + 1]:
+            yield data.iloc[order[bounds[i]:bounds[i + 1]]]
+
+# Harmonize stage for chunks produced by getWISE30sec_comp_stream: WISE layers are moved onto the LPKS
+# depth intervals (see RaggedProfiles.harmonize)
+def harmonize_WISE_chunk(chunk, depths=LPKS_depths):
+    return RaggedProfiles.from_WISE(chunk).harmonize(depths)
+
+# Harmonize stage for chunks that are already on the LPKS depths (id, bedrock_depth, bottom, texture, rfv)
+def split_profile_chunk(chunk, id_col='id'):
+    return RaggedProfiles.from_frame(chunk, id_col=id_col)
+
+# Score stage: run func_prof_comp_GAEZ_SQI on each profile of a chunk (a RaggedProfiles or a list of
+# profile DataFrames) and bind the results.
+# Profiles that fail to score, or have no layers (e.g. WISE water or rock outcrop components), are reported
+# and skipped, as in the R loops.
+def score_profile_chunk(profiles, CROP_ID, inputLevel, depthWt_type=1, source=None):
+    requirements = getGAEZ_requirements(CROP_ID, inputLevel)
+    if isinstance(profiles, RaggedProfiles):
+        ids = profiles.id
+    else:
+        profiles = list(profiles)
+        ids = [prof['id'].iloc[0] if len(prof) > 0 else None for prof in profiles]
+    scores = []
+    for i, prof in enumerate(profiles):
+        if len(prof) == 0:
+            print('ERROR : ' + str(ids[i]) + ' Input data missing')
+            continue
+        try:
+            SQI_scores = func_prof_comp_GAEZ_SQI(prof, CROP_ID, inputLevel, depthWt_type, requirements)
+        except Exception as err:
+            print('ERROR : ' + str(ids[i]) + ' ' + str(err))
+            continue
+        if isinstance(SQI_scores, pd.DataFrame):
+            scores.append(SQI_scores)
+        else:
+            print('ERROR : ' + str(ids[i]) + ' ' + str(SQI_scores))
+    if len(scores) == 0:
+        return None
+    scores = pd.concat(scores, ignore_index=True)
+    if source is not None:
+        scores['data_source'] = source
+    return scores
+
+# -----------------------------------------------------------------------------------------------------
+# Pipeline plumbing
+
+_STOP = object()
+
+# put/get that give up once another stage has failed, so no thread is left blocked on a full/empty queue
+def _queue_put(q, item, stop_event):
+    while not stop_event.is_set():
+        try:
+            q.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def _queue_get(q, stop_event):
+    while not stop_event.is_set():
+        try:
+            return q.get(timeout=0.5)
+        except queue.Empty:
+            continue
+    return _STOP
+
+# Checkpoint file: one line per finished chunk, `chunk_id <tab> output size after the chunk was written`
+def _read_checkpoint(checkpoint_path):
+    done = OrderedDict()
+    if checkpoint_path is not None and os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 2:
+                    done[int(fields[0])] = int(fields[1])
+    return done
+
+def _write_checkpoint(checkpoint_path, chunk_id, size):
+    if checkpoint_path is None:
+        return
+    with open(checkpoint_path, 'a') as f:
+        f.write('%d\t%d\n' % (chunk_id, size))
+        f.flush()
+        os.fsync(f.fileno())
+
+# Write stage. CSV output is appended to a single file; Parquet output is written as one part file per
+# chunk into the `out_path` directory (readable in R with arrow::open_dataset). Returns the output size.
+def _write_chunk(result, out_path, out_format, chunk_id):
+    if out_format == 'csv':
+        if result is not None:
+            header = os.path.getsize(out_path) == 0
+            with open(out_path, 'a', newline='') as f:
+                result.to_csv(f, header=header, index=False)
+                f.flush()
+                os.fsync(f.fileno())
+        return os.path.getsize(out_path)
+    elif out_format == 'parquet':
+        if result is not None:
+            part = os.path.join(out_path, 'part-%06d.parquet' % chunk_id)
+            result.to_parquet(part + '.tmp', index=False)
+            os.replace(part + '.tmp', part)
+        return 0
+
+# Error to re-raise on the calling thread for an exception caught in a pipeline stage. SystemExit and the
+# like (getDataStore_Connection calls sys.exit when it cannot connect) would otherwise only end the stage
+# thread, and the run would finish with chunks missing.
+def _stage_error(err):
+    if isinstance(err, Exception):
+        return err
+    wrapped = RuntimeError('pipeline stage stopped by ' + type(err).__name__ + ': ' + str(err))
+    wrapped.__cause__ = err
+    return wrapped
+
+# Run the streaming pipeline.
+#   chunks: iterable of profile chunks (getWISE30sec_comp_stream, iter_profile_chunks, ...). Chunks are
+#           numbered in iteration order, so the iterable must be deterministic for a run to be resumable.
+#   harmonize: function turning a chunk into scoring-ready profiles (RaggedProfiles or a list of DataFrames)
+#   out_format: 'csv' or 'parquet'
+#   checkpoint_path: if given, chunks already listed in it are skipped and the output is resumed
+#   overwrite: a fresh run (no finished chunks in the checkpoint) refuses to replace existing output
+#              unless overwrite=True
+#   n_workers: number of scoring threads; queue_size: maximum number of chunks waiting between stages.
+#              The threads overlap database reads and file writes with scoring, but they give no CPU
+#              parallelism: scoring is pure Python and holds the GIL, so one core does all the scoring.
+def run_GAEZ_pipeline(chunks, out_path, CROP_ID, inputLevel, depthWt_type=1, harmonize=split_profile_chunk, source=None,
+                      out_format='csv', checkpoint_path=None, overwrite=False, n_workers=2, queue_size=4):
+    if out_format not in ('csv', 'parquet'):
+        raise ValueError('out_format must be `csv` or `parquet`')
+
+    done = _read_checkpoint(checkpoint_path)
+    if out_format == 'csv':
+        if not done and os.path.exists(out_path) and os.path.getsize(out_path) > 0 and not overwrite:
+            raise ValueError(out_path + ' already exists and there is no checkpoint to resume from; use overwrite=True to replace it')
+        # Drop anything written after the last finished chunk (or everything, for a fresh run)
+        size = list(done.values())[-1] if done else 0
+        if size > 0 and (not os.path.exists(out_path) or os.path.getsize(out_path) < size):
+            raise ValueError(out_path + ' is missing or shorter than recorded in ' + checkpoint_path + '; it cannot be resumed')
+        with open(out_path, 'a') as f:
+            f.truncate(size)
+    else:
+        os.makedirs(out_path, exist_ok=True)
+        parts = [f for f in os.listdir(out_path) if f.startswith('part-')]
+        if not done and parts:
+            if not overwrite:
+                raise ValueError(out_path + ' already holds results and there is no checkpoint to resume from; use overwrite=True to replace them')
+            for f in parts:
+                os.remove(os.path.join(out_path, f))
+
+    read_q = queue.Queue(maxsize=queue_size)
+    score_q = queue.Queue(maxsize=queue_size)
+    write_q = queue.Queue(maxsize=queue_size)
+    stop_event = threading.Event()
+    errors = []
+
+    def reader():
+        try:
+            for chunk_id, chunk in enumerate(chunks):
+                if chunk_id in done:
+                    continue
+                if not _queue_put(read_q, (chunk_id, chunk), stop_event):
+                    break
+        except BaseException as err:
+            errors.append(_stage_error(err))
+            stop_event.set()
+        finally:
+            _queue_put(read_q, _STOP, stop_event)
+
+    def harmonizer():
+        try:
+            while True:
+                item = _queue_get(read_q, stop_event)
+                if item is _STOP:
+                    break
+                chunk_id, chunk = item
+                if not _queue_put(score_q, (chunk_id, harmonize(chunk)), stop_event):
+                    break
+        except BaseException as err:
+            errors.append(_stage_error(err))
+            stop_event.set()
+        finally:
+            for w in range(n_workers):
+                _queue_put(score_q, _STOP, stop_event)
+
+    def scorer():
+        try:
+            while True:
+                item = _queue_get(score_q, stop_event)
+                if item is _STOP:
+                    break
+                chunk_id, profiles = item
+                result = score_profile_chunk(profiles, CROP_ID, inputLevel, depthWt_type, source)
+                if not _queue_put(write_q, (chunk_id, result), stop_event):
+                    break
+        except BaseException as err:
+            errors.append(_stage_error(err))
+            stop_event.set()
+        finally:
+            _queue_put(write_q, _STOP, stop_event)
+
+    threads = [threading.Thread(target=reader, daemon=True), threading.Thread(target=harmonizer, daemon=True)]
+    threads = threads + [threading.Thread(target=scorer, daemon=True) for w in range(n_workers)]
+    for t in threads:
+        t.start()
+
+    # the writer runs on the calling thread
+    try:
+        n_stopped = 0
+        while n_stopped < n_workers and not stop_event.is_set():
+            item = _queue_get(write_q, stop_event)
+            if item is _STOP:
+                n_stopped = n_stopped + 1
+                continue
+            chunk_id, result = item
+            size = _write_chunk(result, out_path, out_format, chunk_id)
+            _write_checkpoint(checkpoint_path, chunk_id, size)
+    except BaseException:
+        stop_event.set()
+        raise
+    finally:
+        for t in threads:
+            t.join()
+    if errors:
+        raise errors[0]
+    return out_path
+
+#####################################################################################################
+#                                    ragged profile container                                       #
+#####################################################################################################
+# GAEZ texture class ids, same coding as getTXT_id in func_prof_comp_GAEZ_SQI. 0 is used for a missing texture.
+TXT_class_id = OrderedDict([('clay', 1), ('silty clay', 2), ('silty clay loam', 3), ('clay loam', 4), ('silt', 5), ('silt loam', 6),
+                            ('sandy clay', 7), ('loam', 8), ('sandy clay loam', 9), ('sandy loam', 10), ('loamy sand', 11), ('sand', 12)])
+TXT_class_name = np.array([None] + list(TXT_class_id.keys()), dtype=object)
+
+def getTXT_class_ids(texture):
+    texture = pd.Series(texture, dtype=object).str.lower()
+    return texture.map(TXT_class_id).fillna(0).values.astype(np.int8)
+
+# Group rows by profile id, keeping the first-seen profile order and the row order within each profile.
+# Returns the row order, the profile ids and the CSR offsets of each profile in the reordered rows.
+def _profile_row_order(ids):
+    codes, uniques = pd.factorize(ids)
+    order = np.argsort(codes, kind='stable')
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=len(uniques)))])
+    return order, uniques, offsets
+
+# Compact container for many soil profiles. Layer attributes of all profiles are stored back to back in
+# contiguous arrays (top, bottom, text_class_id, rfv) and the layers of profile i are
+# offsets[i]:offsets[i+1]. Per-profile scalars (id, bedrock, source) have one entry per profile.
+# Horizon colours, when known, are kept as an optional (n_layers x 3) CIELAB layer array `lab`.
+# Slicing with a step-1 slice returns views, and pickling (e.g. to worker processes) only copies the
+# arrays' buffers, which protocol 5 can hand over out-of-band.
+class RaggedProfiles(object):
+    layer_fields = ['top', 'bottom', 'text_class_id', 'rfv']
+    profile_fields = ['id', 'bedrock', 'source']
+
+    def __init__(self, offsets, top, bottom, text_class_id, rfv, id, bedrock, source=None, lab=None):
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.top = np.asarray(top, dtype=np.float32)
+        self.bottom = np.asarray(bottom, dtype=np.float32)
+        self.text_class_id = np.asarray(text_class_id, dtype=np.int8)
+        self.rfv = np.asarray(rfv, dtype=np.float32)
+        self.id = np.asarray(id)
+        self.bedrock = np.asarray(bedrock, dtype=np.float32)
+        if source is None or np.ndim(source) == 0:
+            source = np.full(len(self.id), source, dtype=object)
+        self.source = np.asarray(source, dtype=object)
+        self.lab = None if lab is None else np.asarray(lab, dtype=np.float32).reshape(-1, 3)
+
+    # LPKS-style layer table (id, bedrock_depth, bottom, texture, rfv; optionally top). When `top` is
+    # missing each layer starts at the bottom of the layer above it. Horizon colours are read from a
+    # `lab_Color` column (L, A, B per horizon) or a `munsell` column (e.g. '10YR 3/2') if present.
+    @classmethod
+    def from_frame(cls, data, id_col='id', source=None):
+        order, ids, offsets = _profile_row_order(data[id_col].values)
+        data = data.iloc[order]
+        bottom = data['bottom'].values.astype(np.float32)
+        if 'top' in data.columns:
+            top = data['top'].values.astype(np.float32)
+        else:
+            top = np.concatenate([[0], bottom[:-1]]).astype(np.float32)
+            top[offsets[:-1][np.diff(offsets) > 0]] = 0
+        bedrock = pd.to_numeric(data['bedrock_depth'], errors='coerce').values[offsets[:-1]]
+        if source is None and 'data_source' in data.columns:
+            source = data['data_source'].values[offsets[:-1]]
+        lab = None
+        if 'lab_Color' in data.columns:
+            lab = np.array([np.full(3, np.nan) if v is None or np.size(v) != 3 else v for v in data['lab_Color'].values], dtype=float)
+        elif 'munsell' in data.columns:
+            lab = getMunsell_Lab(data['munsell'].values)
+        return cls(offsets, top, bottom, getTXT_class_ids(data['texture'].values), data['rfv'].values, ids, bedrock, source, lab)
+
+    # WISE30sec layers as returned by getWISE30sec_comp_data / getWISE30sec_comp_stream (one profile per COMPID)
+    @classmethod
+    def from_WISE(cls, data, source='WISE'):
+        data = data.sort_values(['COMPID', 'TopDep'], kind='stable')
+        order, ids, offsets = _profile_row_order(data['COMPID'].values)
+        bedrock = pd.to_numeric(data['REF_DEPTH'], errors='coerce').values[offsets[:-1]]
+        return cls(offsets, data['TopDep'].values, data['BotDep'].values, getTXT_class_ids(data['text_class'].values),
+                   pd.to_numeric(data['CFRAG'], errors='coerce').values, ids, bedrock, source)
+
+    # Join containers back to back; no parts gives an empty container
+    @classmethod
+    def concat(cls, parts):
+        parts = list(parts)
+        if not parts:
+            return cls([0], [], [], [], [], [], [])
+        sizes = np.cumsum([0] + [len(p.top) for p in parts[:-1]])
+        offsets = np.concatenate([[0]] + [p.offsets[1:] - p.offsets[0] + n for p, n in zip(parts, sizes)])
+        layers = [np.concatenate([getattr(p, f)[p.offsets[0]:p.offsets[-1]] for p in parts]) for f in cls.layer_fields]
+        scalars = [np.concatenate([getattr(p, f) for p in parts]) for f in cls.profile_fields]
+        lab = None
+        # parts without layers don't decide whether the result has colours
+        if any(p.lab is not None for p in parts) and all(p.lab is not None or p.offsets[-1] == p.offsets[0] for p in parts):
+            lab = np.concatenate([np.empty((0, 3)) if p.lab is None else p.lab[p.offsets[0]:p.offsets[-1]] for p in parts])
+        return cls(offsets, *(layers + scalars + [lab]))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def layer_counts(self):
+        return np.diff(self.offsets)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return self.profile(key)
+        if isinstance(key, slice) and key.step in (None, 1):
+            start, stop, step = key.indices(len(self))
+            stop = max(start, stop)
+            offsets = self.offsets[start:stop + 1]
+            lo, hi = offsets[0], offsets[-1]
+            return RaggedProfiles(offsets - lo, self.top[lo:hi], self.bottom[lo:hi], self.text_class_id[lo:hi], self.rfv[lo:hi],
+                                  self.id[start:stop], self.bedrock[start:stop], self.source[start:stop],
+                                  None if self.lab is None else self.lab[lo:hi])
+        return self.take(np.arange(len(self))[key])
+
+    # Gather an arbitrary selection of profiles (index array or boolean mask) into a new container
+    def take(self, idx):
+        idx = np.asarray(idx)
+        if idx.dtype == bool:
+            idx = np.flatnonzero(idx)
+        counts = self.layer_counts()[idx]
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        rows = np.repeat(self.offsets[idx] - offsets[:-1], counts) + np.arange(offsets[-1])
+        return RaggedProfiles(offsets, self.top[rows], self.bottom[rows], self.text_class_id[rows], self.rfv[rows],
+                              self.id[idx], self.bedrock[idx], self.source[idx], None if self.lab is None else self.lab[rows])
+
+    # Profile i in the format expected by func_prof_comp_GAEZ_SQI
+    def profile(self, i):
+        if i < 0:
+            i = i + len(self)
+        lo, hi = self.offsets[i], self.offsets[i + 1]
+        return pd.DataFrame({'id': [self.id[i]] * (hi - lo), 'bedrock_depth': float(self.bedrock[i]), 'bottom': self.bottom[lo:hi],
+                             'texture': TXT_class_name[self.text_class_id[lo:hi]], 'rfv': self.rfv[lo:hi]})
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.profile(i)
+
+    # All layers as one long DataFrame
+    def to_frame(self):
+        counts = self.layer_counts()
+        lo, hi = self.offsets[0], self.offsets[-1]
+        frame = pd.DataFrame({'id': np.repeat(self.id, counts), 'bedrock_depth': np.repeat(self.bedrock, counts), 'top': self.top[lo:hi],
+                              'bottom': self.bottom[lo:hi], 'texture': TXT_class_name[self.text_class_id[lo:hi]], 'rfv': self.rfv[lo:hi],
+                              'data_source': np.repeat(self.source, counts)})
+        if self.lab is not None:
+            frame['lab_L'], frame['lab_A'], frame['lab_B'] = self.lab[lo:hi].T
+        return frame
+
+    # Move every profile onto a common set of depth intervals (bottom depths, cm) in one pass. Texture is
+    # taken from the layer with the largest overlap with each interval and rock fragments are
+    # overlap-weighted. Intervals below bedrock or the deepest layer are dropped.
+    def harmonize(self, depths=LPKS_depths):
+        counts = self.layer_counts()
+        nonempty = counts > 0
+        starts = self.offsets[:-1][nonempty]
+        lo, hi = self.offsets[0], self.offsets[-1]
+        top, bottom, rfv, text_class_id = self.top[lo:hi], self.bottom[lo:hi], self.rfv[lo:hi], self.text_class_id[lo:hi]
+        starts = starts - lo
+        prof = np.repeat(np.arange(len(self)), counts)
+
+        d_bot = np.asarray(depths, dtype=np.float32)
+        d_top = np.concatenate([[0], d_bot[:-1]]).astype(np.float32)
+        keep = np.zeros((len(self), len(d_bot)), dtype=bool)
+        new_rfv = np.zeros((len(self), len(d_bot)), dtype=np.float32)
+        new_txt = np.zeros((len(self), len(d_bot)), dtype=np.int8)
+        new_lab = np.full((len(self), len(d_bot), 3), np.nan, dtype=np.float32)
+        if len(starts) > 0:
+            deepest = np.maximum.reduceat(bottom, starts)
+            soil_depth = np.fmin(deepest, self.bedrock[nonempty])
+            limit = np.minimum(d_bot[None, :], np.repeat(soil_depth, counts[nonempty])[:, None])
+            overlap = np.clip(np.minimum(bottom[:, None], limit) - np.maximum(top[:, None], d_top[None, :]), 0, None)
+            covered = np.add.reduceat(overlap, starts, axis=0)
+            rfv_sum = np.add.reduceat(overlap * rfv[:, None], starts, axis=0)
+            ends = np.append(starts[1:], len(top)) - 1
+            layer = np.arange(len(top))
+            for d in range(len(d_bot)):
+                # per profile, the first layer with the largest overlap
+                order = np.lexsort((-layer, overlap[:, d], prof))
+                new_txt[nonempty, d] = text_class_id[order[ends]]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                new_rfv[nonempty] = rfv_sum / covered
+                if self.lab is not None:
+                    # overlap-weighted mean colour over the layers with a known colour
+                    lab = self.lab[lo:hi]
+                    lab_wt = overlap * ~np.isnan(lab[:, :1])
+                    lab_sum = np.add.reduceat(lab_wt[:, :, None] * np.nan_to_num(lab)[:, None, :], starts, axis=0)
+                    new_lab[nonempty] = lab_sum / np.add.reduceat(lab_wt, starts, axis=0)[:, :, None]
+            keep[nonempty] = covered > 0
+
+        offsets = np.concatenate([[0], np.cumsum(keep.sum(axis=1))])
+        return RaggedProfiles(offsets, np.broadcast_to(d_top, keep.shape)[keep], np.broadcast_to(d_bot, keep.shape)[keep],
+                              new_txt[keep], new_rfv[keep], self.id, self.bedrock, self.source,
+                              None if self.lab is None else new_lab[keep])
+
+#####################################################################################################
+#                                 cross-source comparison cube                                      #
+#####################################################################################################
+# Suitability classes of a 0-100 rating, with the same breaks as S_Class in the R notebook:
+#   N < 10 <= S4 < 40 <= S3 < 60 <= S2 < 85 <= S1 < 95 <= S0
+SR_class_labels = np.array(['N', 'S4', 'S3', 'S2', 'S1', 'S0'])
+SR_class_breaks = [10, 40, 60, 85, 95]
+
+# Index into SR_class_labels for each rating; -1 where the rating is missing
+def getSR_class_id(rating):
+    rating = np.asarray(rating, dtype=float)
+    return np.where(np.isnan(rating), -1, np.digitize(rating, SR_class_breaks))
+
+# Align long scoring results (one row per site and data source, as written by run_GAEZ_pipeline or
+# bound in R) into a (site x source x metric) array. Missing site/source combinations are NaN.
+# `sources` fixes the source order (e.g. ['LPKS', 'SG', 'HWSD', 'WISE', 'ISDA']); sources not listed are dropped.
+# `keys` are further columns that identify a score besides site and source (e.g. ['depthWt_type'] when
+# several depth-weight schemes were scored); each (site, keys) combination is then one row of the cube and
+# `sites` is returned as a DataFrame of id_col + keys, whose columns can be passed as `groups` to
+# compare_SQI_sources. Duplicate (site, source, keys) rows raise a ValueError.
+def getSQI_cube(scores, metrics=['SQ1', 'SQ3', 'SQ7', 'SR'], sources=None, id_col='id', source_col='data_source', keys=None):
+    if keys:
+        key_cols = [id_col] + list(keys)
+        site_idx = scores.groupby(key_cols, sort=False, dropna=False).ngroup().values
+        sites = scores[key_cols].drop_duplicates().reset_index(drop=True)
+    else:
+        site_idx, sites = pd.factorize(scores[id_col])
+        sites = np.asarray(sites)
+    if sources is None:
+        src_idx, sources = pd.factorize(scores[source_col])
+    else:
+        src_idx = pd.Index(sources).get_indexer(scores[source_col])
+    sources = np.asarray(sources)
+    values = np.column_stack([pd.to_numeric(scores[m], errors='coerce').values for m in metrics])
+
+    keep = src_idx >= 0
+    cell = site_idx[keep] * len(sources) + src_idx[keep]
+    dup = pd.Series(cell).duplicated(keep=False).values
+    if dup.any():
+        raise ValueError('duplicate scores for ' + str(int(dup.sum())) + ' rows, e.g.:\n' +
+                         scores[keep][dup].head().to_string() + '\nadd the columns that tell them apart to `keys`')
+
+    cube = np.full((len(sites), len(sources), len(metrics)), np.nan)
+    cube[site_idx[keep], src_idx[keep]] = values[keep]
+    return cube, sites, sources
+
+# Compare every pair of sources in one pass over the (site x source x metric) cube from getSQI_cube.
+# For each group of sites (e.g. AEZ or depth-weight scheme; `groups` is one label per site, a Series
+# indexed by site id, or a column of the `sites` DataFrame getSQI_cube returns with `keys`) and each ordered source pair (a, b) this gives the number of sites scored by both,
+# the bias (mean a - b), the mean absolute error, the RMSE and the share of sites in the same suitability
+# class. Returns a long DataFrame, plus the per-site difference array (site x a x b x metric) if `return_diff`.
+def compare_SQI_sources(cube, sources, metrics=['SQ1', 'SQ3', 'SQ7', 'SR'], groups=None, sites=None, return_diff=False):
+    n_sites, n_src, n_met = cube.shape
+    if groups is None:
+        group_idx, group_labels = np.zeros(n_sites, dtype=int), np.array(['all'])
+    else:
+        if isinstance(sites, pd.DataFrame):
+            if isinstance(groups, str):
+                groups = sites[groups].values
+            elif isinstance(groups, pd.Series):
+                groups = groups.reindex(sites.iloc[:, 0]).values
+        elif isinstance(groups, pd.Series):
+            groups = groups.reindex(sites).values
+        group_idx, group_labels = pd.factorize(np.asarray(groups))
+
+    diff = cube[:, :, None, :] - cube[:, None, :, :]
+    valid = ~np.isnan(diff)
+    diff0 = np.where(valid, diff, 0)
+    sc = getSR_class_id(cube)
+    sc_valid = (sc[:, :, None, :] >= 0) & (sc[:, None, :, :] >= 0)
+    sc_agree = sc_valid & (sc[:, :, None, :] == sc[:, None, :, :])
+
+    # grouped sums for all statistics as one matrix product with the site -> group indicator matrix
+    onehot = np.zeros((len(group_labels), n_sites))
+    onehot[group_idx[group_idx >= 0], np.flatnonzero(group_idx >= 0)] = 1
+    stacked = np.stack([valid, diff0, np.abs(diff0), diff0 ** 2, sc_valid, sc_agree], axis=1).astype(float)
+    sums = (onehot @ stacked.reshape(n_sites, -1)).reshape((len(group_labels), 6, n_src, n_src, n_met))
+    n, s_diff, s_abs, s_sq, n_sc, n_agree = [sums[:, k] for k in range(6)]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        stats = {'n': n, 'bias': s_diff / n, 'mae': s_abs / n, 'rmse': np.sqrt(s_sq / n), 'class_agreement': n_agree / n_sc}
+
+    g, a, b, m = np.meshgrid(np.arange(len(group_labels)), np.arange(n_src), np.arange(n_src), np.arange(n_met), indexing='ij')
+    pairs = (a != b).ravel()
+    result = pd.DataFrame({'group': np.asarray(group_labels)[g.ravel()[pairs]], 'metric': np.asarray(metrics)[m.ravel()[pairs]],
+                           'source_a': sources[a.ravel()[pairs]], 'source_b': sources[b.ravel()[pairs]]})
+    for k, v in stats.items():
+        result[k] = v.ravel()[pairs]
+    result['n'] = result['n'].astype(int)
+    if return_diff:
+        return result, diff
+    return result
+
+#####################################################################################################
+#                                  profile similarity search                                        #
+#####################################################################################################
+# Representative sand and clay (%) of each texture class id (values of getSand/getClay); id 0 (missing) is NaN
+TXT_class_sand = np.array([np.nan, 22.5, 10.0, 10.0, 32.5, 10.0, 25.0, 55.0, 37.5, 62.5, 61.5, 80.0, 92.0])
+TXT_class_clay = np.array([np.nan, 70.0, 50.0, 33.5, 33.5, 6.0, 13.5, 45.0, 17.0, 27.5, 10.0, 7.5, 5.0])
+
+SQI_features = ['SQ1', 'SQ3', 'SQ7', 'SR']
+
+# (profile, depth interval) position of every layer of profiles harmonized onto `depths`
+def _depth_grid_index(prof, depths):
+    rows = np.repeat(np.arange(len(prof)), prof.layer_counts())
+    cols = np.searchsorted(np.asarray(depths, dtype=np.float32), prof.bottom[prof.offsets[0]:prof.offsets[-1]])
+    return rows, cols
+
+# Functional feature vector of each profile, for nearest-profile search. Profiles are harmonized onto
+# `depths` and every interval contributes sand, clay and rock fragments (as fractions), scaled by the square
+# root of its GAEZ depth weight so that squared Euclidean distance is depth-weighted like the SQI scores.
+# Intervals below a recorded bedrock depth are treated as rock (no sand/clay, 100% rock fragments).
+# Intervals (or properties) that are simply not described are imputed from the nearest described interval
+# of the same profile, and from a loam with no rock fragments for profiles without any described layer.
+# Soil depth is the bedrock depth, 120 cm when no bedrock is recorded as in the scorer. Soil depth and,
+# optionally, the SQI scores (`sqi`: DataFrame with one row per `id`, or an array aligned with the profiles)
+# are appended; `sqi_weight` sets how much the scores count relative to the layer properties.
+def getProfile_features(profiles, sqi=None, depths=LPKS_depths, depthWt_type=1, sqi_weight=1.0):
+    if isinstance(profiles, pd.DataFrame):
+        profiles = RaggedProfiles.from_frame(profiles)
+    prof = profiles.harmonize(depths)
+    n_prof, n_depth = len(prof), len(depths)
+    wts = getGAEZ_depth_wts(n_depth, depthWt_type)
+    if wts is None:
+        wts = [1] * n_depth
+    wts = np.sqrt(np.asarray(wts, dtype=float))
+
+    rows, cols = _depth_grid_index(prof, depths)
+    txt = prof.text_class_id[prof.offsets[0]:prof.offsets[-1]]
+    layers = {'sand': TXT_class_sand[txt] / 100, 'clay': TXT_class_clay[txt] / 100, 'rfv': prof.rfv[prof.offsets[0]:prof.offsets[-1]] / 100}
+    fill = {'sand': TXT_class_sand[TXT_class_id['loam']] / 100, 'clay': TXT_class_clay[TXT_class_id['loam']] / 100, 'rfv': 0.0}
+    rock = {'sand': 0.0, 'clay': 0.0, 'rfv': 1.0}
+    tops = np.concatenate([[0], depths[:-1]])
+    below_bedrock = tops[None, :] >= prof.bedrock[:, None]
+
+    features = []
+    for f in ['sand', 'clay', 'rfv']:
+        grid = np.full((n_prof, n_depth), np.nan)
+        grid[rows, cols] = layers[f]
+        grid[below_bedrock] = np.nan
+        grid = pd.DataFrame(grid).ffill(axis=1).bfill(axis=1).fillna(fill[f]).values
+        grid[below_bedrock] = rock[f]
+        features.append(grid * wts)
+
+    soil_depth = np.where(np.isnan(prof.bedrock), 120, prof.bedrock)
+    features.append((np.fmin(soil_depth, 120) / 120)[:, None])
+
+    if sqi is not None:
+        if isinstance(sqi, pd.DataFrame):
+            if sqi['id'].duplicated().any():
+                raise ValueError('`sqi` has more than one row for some ids (e.g. one per data_source); select one set of scores per profile')
+            sqi = sqi.set_index('id')[SQI_features].reindex(prof.id)
+            sqi = sqi.apply(pd.to_numeric, errors='coerce').values
+        features.append(sqi_weight * np.asarray(sqi, dtype=float) / 100)
+    return np.nan_to_num(np.hstack(features))
+
+# k nearest rows of X for every row of Q, computed block by block so that the distance matrix held in memory
+# is at most query_block x index_block
+def _blocked_knn(Q, X, k, query_block=256, index_block=65536):
+    dist = np.empty((len(Q), k))
+    idx = np.empty((len(Q), k), dtype=np.int64)
+    for q0 in range(0, len(Q), query_block):
+        q = Q[q0:q0 + query_block]
+        best_d = np.full((len(q), k), np.inf)
+        best_i = np.zeros((len(q), k), dtype=np.int64)
+        for x0 in range(0, len(X), index_block):
+            d = euclidean_distances(q, X[x0:x0 + index_block], squared=True)
+            cand_d = np.hstack([best_d, d])
+            cand_i = np.hstack([best_i, np.arange(x0, x0 + d.shape[1])[None, :].repeat(len(q), axis=0)])
+            part = np.argpartition(cand_d, k - 1, axis=1)[:, :k]
+            best_d = np.take_along_axis(cand_d, part, axis=1)
+            best_i = np.take_along_axis(cand_i, part, axis=1)
+        order = np.argsort(best_d, axis=1)
+        dist[q0:q0 + len(q)] = np.sqrt(np.take_along_axis(best_d, order, axis=1))
+        idx[q0:q0 + len(q)] = np.take_along_axis(best_i, order, axis=1)
+    return dist, idx
+
+# Nearest-profile index over a set of profiles (e.g. all WISE30sec components, see build_WISE_index).
+# method: 'kd_tree', 'ball_tree', 'brute' (blocked exact search) or 'auto' (kd_tree up to 20 features,
+# brute above that, where trees stop pruning well).
+# colour_weight > 0 adds horizon colour to the matching when the indexed profiles carry colours: the
+# `colour_candidates` x k nearest profiles by properties are re-ranked on
+# sqrt(d**2 + (colour_weight * dE00 / 100)**2), with dE00 the depth-weighted CIEDE2000 distance.
+# Candidates without a comparable colour get the largest dE00 among the query's candidates, so missing
+# colour never ranks above an observed one at equal property distance; queries without any colour are ranked on properties alone.
+class ProfileIndex(object):
+    def __init__(self, profiles, sqi=None, depths=LPKS_depths, depthWt_type=1, sqi_weight=1.0, method='auto', leaf_size=40,
+                 colour_weight=0.0, colour_candidates=4):
+        if isinstance(profiles, pd.DataFrame):
+            profiles = RaggedProfiles.from_frame(profiles)
+        self.depths = depths
+        self.depthWt_type = depthWt_type
+        self.sqi_weight = sqi_weight
+        self.use_sqi = sqi is not None
+        self.id = profiles.id
+        self.features = getProfile_features(profiles, sqi, depths, depthWt_type, sqi_weight)
+        self.colour_weight = colour_weight
+        self.colour_candidates = colour_candidates
+        self.lab_grid = None
+        if colour_weight > 0 and profiles.lab is not None:
+            self.lab_grid = getProfile_lab_grid(profiles, depths)
+        if method == 'auto':
+            method = 'kd_tree' if self.features.shape[1] <= 20 else 'brute'
+        if method == 'kd_tree':
+            self.tree = KDTree(self.features, leaf_size=leaf_size)
+        elif method == 'ball_tree':
+            self.tree = BallTree(self.features, leaf_size=leaf_size)
+        elif method == 'brute':
+            self.tree = None
+        else:
+            raise ValueError('method must be `auto`, `kd_tree`, `ball_tree` or `brute`')
+        self.method = method
+
+    def __len__(self):
+        return len(self.id)
+
+    # Distances and positions (into self.id) of the k most similar indexed profiles for each query profile
+    def query(self, profiles, k=5, sqi=None):
+        if self.use_sqi and sqi is None:
+            raise ValueError('the index includes SQI scores; please enter `sqi` for the query profiles')
+        if isinstance(profiles, pd.DataFrame):
+            profiles = RaggedProfiles.from_frame(profiles)
+        Q = getProfile_features(profiles, sqi if self.use_sqi else None, self.depths, self.depthWt_type, self.sqi_weight)
+        use_colour = self.lab_grid is not None and profiles.lab is not None
+        k_out = min(k, len(self))
+        if use_colour:
+            k = min(k * self.colour_candidates, len(self))
+        else:
+            k = k_out
+        if self.tree is not None:
+            dist, idx = self.tree.query(Q, k=k)
+        else:
+            dist, idx = _blocked_knn(Q, self.features, k)
+        if not use_colour:
+            return dist, idx
+
+        # re-rank the candidates of every query on property and colour distance together
+        query_lab = getProfile_lab_grid(profiles, self.depths)
+        dE = color.deltaE_ciede2000(query_lab[:, None], self.lab_grid[idx])
+        dE = _depth_weighted_mean(dE, self.depthWt_type)
+        missing = np.isnan(dE)
+        worst = np.fmax.reduce(dE, axis=1)
+        dE = np.nan_to_num(np.where(missing, worst[:, None], dE))
+        dist = np.sqrt(dist ** 2 + (self.colour_weight * dE / 100) ** 2)
+        # at equal distance, candidates with a colour come first
+        order = np.lexsort((missing, dist), axis=1)[:, :k_out]
+        return np.take_along_axis(dist, order, axis=1), np.take_along_axis(idx, order, axis=1)
+
+    # As query, as a long DataFrame: query id, rank, matched id and distance
+    def query_frame(self, profiles, k=5, sqi=None):
+        if isinstance(profiles, pd.DataFrame):
+            profiles = RaggedProfiles.from_frame(profiles)
+        dist, idx = self.query(profiles, k, sqi)
+        return pd.DataFrame({'id': np.repeat(profiles.id, idx.shape[1]), 'rank': np.tile(np.arange(1, idx.shape[1] + 1), len(idx)),
+                             'match_id': self.id[idx.ravel()], 'distance': dist.ravel()})
+
+# Build a ProfileIndex over all WISE30sec components of a set of map units, streaming the components
+# from the database in chunks
+def build_WISE_index(MUGLB_NEW_Select, sqi=None, depths=LPKS_depths, depthWt_type=1, sqi_weight=1.0, method='auto', chunk_size=5000):
+    profiles = RaggedProfiles.concat(harmonize_WISE_chunk(chunk, depths) for chunk in getWISE30sec_comp_stream(MUGLB_NEW_Select, chunk_size))
+    if len(profiles) == 0:
+        raise ValueError('no WISE30sec components found for the selected map units')
+    return ProfileIndex(profiles, sqi, depths, depthWt_type, sqi_weight, method)
+
+#####################################################################################################
+#                                  horizon colour similarity                                        #
+#####################################################################################################
+# CIELAB colour of Munsell notations (e.g. '10YR 3/2'), converted once per distinct notation. The Munsell
+# renotation data are defined for illuminant C, which is also used as the Lab white point.
+# Missing or unparseable notations give NaN.
+def getMunsell_Lab(munsell):
+    codes, uniques = pd.factorize(pd.Series(munsell, dtype=object))
+    illuminant_C = colour.CCS_ILLUMINANTS['CIE 1931 2 Degree Standard Observer']['C']
+    lab = np.full((len(uniques) + 1, 3), np.nan)
+    for i in range(len(uniques)):
+        try:
+            xyY = colour.munsell_colour_to_xyY(str(uniques[i]).strip())
+            lab[i] = colour.XYZ_to_Lab(colour.xyY_to_XYZ(xyY), illuminant_C)
+        except Exception:
+            continue
+    # code -1 (missing notation) picks the trailing NaN row
+    return lab[codes]
+
+# Horizon colours of every profile on the `depths` intervals, as a (profiles x intervals x 3) Lab array.
+# Colours are overlap-weighted means of the layer colours; intervals without a colour are NaN.
+def getProfile_lab_grid(profiles, depths=LPKS_depths):
+    if isinstance(profiles, pd.DataFrame):
+        profiles = RaggedProfiles.from_frame(profiles)
+    if profiles.lab is None:
+        raise ValueError('profiles have no horizon colours (`lab_Color` or `munsell`)')
+    prof = profiles.harmonize(depths)
+    rows, cols = _depth_grid_index(prof, depths)
+    grid = np.full((len(prof), len(depths), 3), np.nan)
+    grid[rows, cols] = prof.lab[prof.offsets[0]:prof.offsets[-1]]
+    return grid
+
+# Mean over the last (depth interval) axis using the GAEZ depth weights of the SQI scores, leaving out
+# missing values
+def _depth_weighted_mean(values, depthWt_type=1):
+    n_depth = values.shape[-1]
+    wts = getGAEZ_depth_wts(n_depth, depthWt_type)
+    if wts is None:
+        wts = [1] * n_depth
+    wts = np.where(np.isnan(values), 0, np.asarray(wts, dtype=float))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.nansum(values * wts, axis=-1) / wts.sum(axis=-1)
+
+# Depth-weighted CIEDE2000 colour distance between every query profile and every candidate profile,
+# as a (queries x candidates) array. Profiles are RaggedProfiles/DataFrames with colours, or Lab grids from
+# getProfile_lab_grid. Intervals without a colour in either profile are left out; pairs with no common
+# coloured interval are NaN. Queries and candidates are processed in query_block x block_size blocks to
+# bound memory.
+def profile_colour_distance(query, candidates, depths=LPKS_depths, depthWt_type=1, block_size=1024, query_block=256):
+    query_lab = query if isinstance(query, np.ndarray) else getProfile_lab_grid(query, depths)
+    cand_lab = candidates if isinstance(candidates, np.ndarray) else getProfile_lab_grid(candidates, depths)
+    dist = np.empty((len(query_lab), len(cand_lab)))
+    for q0 in range(0, len(query_lab), query_block):
+        q = query_lab[q0:q0 + query_block, None]
+        for c0 in range(0, len(cand_lab), block_size):
+            dE = color.deltaE_ciede2000(q, cand_lab[None, c0:c0 + block_size])
+            dist[q0:q0 + query_block, c0:c0 + block_size] = _depth_weighted_mean(dE, depthWt_type)
+    return dist
+
+#####################################################################################################
+#                                     AEZ regional rollups                                          #
+#####################################################################################################
+# Sites and raster cells are assigned to agro-ecological zones once (a point-in-polygon join for sites,
+# a cached zone-id raster for cells), then SR/SQI statistics for every zone and metric come from a single
+# sorted group-by reduction. Statistics can be weighted, e.g. by HarvestChoice maize production
+# (analysis/data/Havest_Choice/Crops_Production/cell5m_Agriculture_Crops_production_MAIZ_R_P.tif).
+
+# Raster band as a float array with nodata set to NaN
+def _read_band(ds, band=1):
+    b = ds.GetRasterBand(band)
+    arr = b.ReadAsArray().astype(float)
+    nodata = b.GetNoDataValue()
+    if nodata is not None:
+        arr[arr == nodata] = np.nan
+    return arr
+
+# True if the rasters are on the same grid: size, geotransform and projection
+def _same_grid(ds, tmpl):
+    if (ds.RasterXSize, ds.RasterYSize) != (tmpl.RasterXSize, tmpl.RasterYSize):
+        return False
+    if not np.allclose(ds.GetGeoTransform(), tmpl.GetGeoTransform()):
+        return False
+    srs, tmpl_srs = osr.SpatialReference(), osr.SpatialReference()
+    srs.ImportFromWkt(ds.GetProjection())
+    tmpl_srs.ImportFromWkt(tmpl.GetProjection())
+    return bool(srs.IsSame(tmpl_srs))
+
+# True if `out_path` exists, is newer than all of `src_paths` and is on the grid of `template_path`. The
+# grid is checked because a different template can be older than the cache.
+def _is_cached(out_path, src_paths, template_path):
+    if not os.path.exists(out_path) or any(os.path.getmtime(out_path) < os.path.getmtime(p) for p in src_paths):
+        return False
+    cached = gdal.Open(out_path)
+    return cached is not None and _same_grid(cached, gdal.Open(template_path))
+
+# Values of a (lon/lat) raster at point locations; NaN outside the raster
+def getRaster_values(raster_path, lon, lat):
+    ds = gdal.Open(raster_path)
+    gt = ds.GetGeoTransform()
+    arr = _read_band(ds)
+    col = np.floor((np.asarray(lon, dtype=float) - gt[0]) / gt[1]).astype(int)
+    row = np.floor((np.asarray(lat, dtype=float) - gt[3]) / gt[5]).astype(int)
+    inside = (row >= 0) & (row < arr.shape[0]) & (col >= 0) & (col < arr.shape[1])
+    values = np.full(len(col), np.nan)
+    values[inside] = arr[row[inside], col[inside]]
+    return values
+
+# Warp a raster onto the grid of `template_path` (cached in `out_path`). Use resampling='average' when
+# the template grid is coarser than the source.
+def getRaster_aligned(src_path, template_path, out_path, resampling='near'):
+    if _is_cached(out_path, [src_path, template_path], template_path):
+        return out_path
+    if os.path.exists(out_path):
+        os.remove(out_path)
+    tmpl = gdal.Open(template_path)
+    gt = tmpl.GetGeoTransform()
+    bounds = (gt[0], gt[3] + gt[5] * tmpl.RasterYSize, gt[0] + gt[1] * tmpl.RasterXSize, gt[3])
+    gdal.Warp(out_path, src_path, format='GTiff', outputBounds=bounds, width=tmpl.RasterXSize, height=tmpl.RasterYSize,
+              dstSRS=tmpl.GetProjection(), resampleAlg=resampling, creationOptions=['COMPRESS=DEFLATE'])
+    return out_path
+
+# AEZ names, sorted; zone id i + 1 in the zone raster is AEZ_labels[i] and 0 is outside all zones
+def getAEZ_labels(aez_path, field='AEZ'):
+    aez = gpd.read_file(aez_path)
+    return np.sort(aez[field].dropna().astype(str).str.strip().unique())
+
+# Rasterize the AEZ polygons onto the grid of `template_path` (e.g. an SR raster) as zone ids. The result
+# is cached in `out_path` and only rebuilt when the polygons or the template change.
+def getAEZ_zone_raster(aez_path, template_path, out_path, field='AEZ'):
+    labels = getAEZ_labels(aez_path, field)
+    if _is_cached(out_path, [aez_path, template_path], template_path):
+        return out_path, labels
+    if os.path.exists(out_path):
+        os.remove(out_path)
+    tmpl = gdal.Open(template_path)
+    ds = gdal.GetDriverByName('GTiff').Create(out_path, tmpl.RasterXSize, tmpl.RasterYSize, 1, gdal.GDT_Int16, options=['COMPRESS=DEFLATE'])
+    ds.SetGeoTransform(tmpl.GetGeoTransform())
+    ds.SetProjection(tmpl.GetProjection())
+    band = ds.GetRasterBand(1)
+    band.SetNoDataValue(0)
+    band.Fill(0)
+
+    # copy the polygons to a memory layer with an integer zone id to burn
+    src = ogr.Open(aez_path)
+    layer = src.GetLayer()
+    mem = ogr.GetDriverByName('Memory').CreateDataSource('')
+    zones = mem.CreateLayer('zones', layer.GetSpatialRef(), ogr.wkbMultiPolygon)
+    zones.CreateField(ogr.FieldDefn('zone_id', ogr.OFTInteger))
+    for feat in layer:
+        name = feat.GetField(field)
+        if name is None:
+            continue
+        zone = ogr.Feature(zones.GetLayerDefn())
+        zone.SetGeometry(feat.GetGeometryRef().Clone())
+        zone.SetField('zone_id', int(np.searchsorted(labels, name.strip())) + 1)
+        zones.CreateFeature(zone)
+    gdal.RasterizeLayer(ds, [1], zones, options=['ATTRIBUTE=zone_id'])
+    ds.FlushCache()
+    ds = None
+    return out_path, labels
+
+# AEZ of each site (DataFrame with lon/lat columns, WGS84) by a spatially indexed point-in-polygon join.
+# Returns a Series aligned with `sites`; sites outside all zones are NaN.
+def getAEZ_site_zones(sites, aez_path, lon_col='lon', lat_col='lat', field='AEZ'):
+    aez = gpd.read_file(aez_path)[[field, 'geometry']]
+    aez[field] = aez[field].astype(str).str.strip()
+    pts = gpd.GeoDataFrame(index=np.arange(len(sites)), geometry=gpd.points_from_xy(sites[lon_col].values, sites[lat_col].values), crs='EPSG:4326')
+    joined = gpd.sjoin(pts, aez.to_crs(pts.crs), how='left')
+    joined = joined[~joined.index.duplicated(keep='first')]
+    return pd.Series(joined[field].reindex(np.arange(len(sites))).values, index=sites.index, name=field)
+
+# Grouped (optionally weighted) statistics of ratings. For every group of `by` and every metric: number of
+# values, total weight, mean, quantiles (inverted weighted CDF) and the weight share of each suitability
+# class (share_N ... share_S0, breaks as getSR_class_id). Missing ratings and non-positive weights are left out.
+def rollup_ratings(data, by, metrics=SQI_features, weight=None, quantiles=[0.1, 0.25, 0.5, 0.75, 0.9]):
+    grouped = data.groupby(by, sort=True)
+    codes = grouped.ngroup().fillna(-1).values.astype(np.int64)
+    keys = grouped.size().index.to_frame(index=False)
+    n_group = len(keys)
+    quantiles = np.asarray(quantiles, dtype=float)
+    if weight is None:
+        w_all = np.ones(len(data))
+    else:
+        w_all = pd.to_numeric(data[weight], errors='coerce').fillna(0).values.astype(float)
+
+    out = []
+    for m in metrics:
+        v = pd.to_numeric(data[m], errors='coerce').values.astype(float)
+        ok = (codes >= 0) & ~np.isnan(v) & (w_all > 0)
+        # one sort by group, then value
+        order = np.lexsort((v[ok], codes[ok]))
+        c, v, w = codes[ok][order], v[ok][order], w_all[ok][order]
+
+        n = np.bincount(c, minlength=n_group)
+        w_sum = np.bincount(c, weights=w, minlength=n_group)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.bincount(c, weights=w * v, minlength=n_group) / w_sum
+
+            # the within-group cumulative weight share, offset by the group number, increases over the
+            # whole sorted array, so all group quantiles come from one searchsorted
+            start = np.concatenate([[0], np.cumsum(n)[:-1]])
+            cw = np.cumsum(w)
+            cw_before = np.concatenate([[0], cw])[start]
+            key = c + (cw - cw_before[c]) / w_sum[c]
+        pos = np.searchsorted(key, np.arange(n_group)[:, None] + quantiles[None, :])
+        pos = np.clip(pos, start[:, None], np.maximum(start + n - 1, 0)[:, None])
+        qv = v[np.minimum(pos, max(len(v) - 1, 0))] if len(v) > 0 else np.full(pos.shape, np.nan)
+        qv[n == 0] = np.nan
+
+        shares = np.bincount(c * len(SR_class_labels) + getSR_class_id(v), weights=w, minlength=n_group * len(SR_class_labels))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            shares = shares.reshape(n_group, len(SR_class_labels)) / w_sum[:, None]
+
+        stats = keys.copy()
+        stats['metric'] = m
+        stats['n'] = n
+        stats['weight'] = w_sum
+        stats['mean'] = mean
+        for i, q in enumerate(quantiles):
+            stats['q%g' % (q * 100)] = qv[:, i]
+        for i, sc in enumerate(SR_class_labels):
+            stats['share_' + sc] = shares[:, i]
+        out.append(stats)
+    return pd.concat(out, ignore_index=True)
+
+# Rollup of site scores (long results with `id_col`, e.g. from run_GAEZ_pipeline) by AEZ and `by`
+# (e.g. data_source), optionally weighted by a production raster sampled at the sites
+def rollup_site_ratings(scores, sites, aez_path, by=['data_source'], weight_path=None, metrics=SQI_features,
+                        quantiles=[0.1, 0.25, 0.5, 0.75, 0.9], id_col='id', lon_col='lon', lat_col='lat', field='AEZ'):
+    site_info = pd.DataFrame({id_col: sites[id_col].values, field: getAEZ_site_zones(sites, aez_path, lon_col, lat_col, field).values})
+    weight = None
+    if weight_path is not None:
+        site_info['weight'] = getRaster_values(weight_path, sites[lon_col].values, sites[lat_col].values)
+        weight = 'weight'
+    data = scores.merge(site_info, on=id_col, how='inner')
+    return rollup_ratings(data, [field] + list(by), metrics, weight, quantiles)
+
+# Rollup of rating rasters (`rating_paths`: {metric: path}, all on one grid) by AEZ, optionally weighted by
+# a production raster. The zone raster and the aligned weight raster are cached next to `cache_prefix`.
+def rollup_raster_ratings(rating_paths, aez_path, cache_prefix, weight_path=None, quantiles=[0.1, 0.25, 0.5, 0.75, 0.9],
+                          field='AEZ', weight_resampling='near'):
+    metrics = list(rating_paths.keys())
+    template_path = rating_paths[metrics[0]]
+    zone_path, labels = getAEZ_zone_raster(aez_path, template_path, cache_prefix + '_zones.tif', field)
+    zones = gdal.Open(zone_path).GetRasterBand(1).ReadAsArray().ravel()
+    inside = zones > 0
+
+    data = pd.DataFrame({field: labels[zones[inside] - 1]})
+    for m in metrics:
+        data[m] = _read_band(gdal.Open(rating_paths[m])).ravel()[inside]
+    weight = None
+    if weight_path is not None:
+        aligned = getRaster_aligned(weight_path, template_path, cache_prefix + '_weight.tif', weight_resampling)
+        data['weight'] = _read_band(gdal.Open(aligned)).ravel()[inside]
+        weight = 'weight'
+    return rollup_ratings(data, [field], metrics, weight, quantiles)
+
+#####################################################################################################
+#                                   Arrow hand-off of scores                                        #
+#####################################################################################################
+# Batched scoring that returns Arrow record batches instead of one DataFrame per profile. A pyarrow Table
+# reaches R through reticulate and the arrow package (py_to_r) via the Arrow C data interface without a
+# copy or a per-row conversion, and an Arrow IPC (Feather v2) file written here can be memory-mapped in R with
+#   arrow::read_feather(path, as_data_frame = FALSE, mmap = TRUE)
+
+SQI_columns = ['SQ1', 'SQ2', 'SQ3', 'SQ7', 'SR']
+
+# Schema of batched scoring results: same columns as func_prof_comp_GAEZ_SQI plus data_source. Scores that
+# do not apply (e.g. SQ1 at high input) are null; `Input Level` and data_source are dictionary encoded
+# and read as factors in R.
+def getSQI_arrow_schema(id_type=pa.int64()):
+    return pa.schema([('id', id_type)] + [(c, pa.float64()) for c in SQI_columns] +
+                     [('Input Level', pa.dictionary(pa.int32(), pa.string())), ('data_source', pa.dictionary(pa.int32(), pa.string()))])
+
+def _score_or_null(score):
+    if score is None or isinstance(score, str):
+        return None
+    return float(score)
+
+# Dictionary-encode `values` against a fixed dictionary; values not in it are null
+def _dictionary_array(values, dictionary):
+    indices = pd.Index(dictionary.to_pandas()).get_indexer(pd.Series(values, dtype=object))
+    return pa.DictionaryArray.from_arrays(pa.array(indices, type=pa.int32(), mask=indices < 0), dictionary)
+
+# `dictionaries` holds one fixed dictionary per encoded column, shared by all batches of a stream: the IPC
+# file format does not allow a dictionary to change between batches
+def _SQI_record_batch(columns, schema, dictionaries):
+    arrays = [pa.array(columns['id'], type=schema.field('id').type)]
+    arrays = arrays + [pa.array(columns[c], type=pa.float64()) for c in SQI_columns]
+    arrays = arrays + [_dictionary_array(columns[c], dictionaries[c]) for c in ['Input Level', 'data_source']]
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+# Score profiles and yield the results as record batches of up to `batch_size` rows. The requirement tables
+# are fetched once for all profiles.
+def iter_GAEZ_SQI_batches(profiles, CROP_ID, inputLevel, depthWt_type=1, source=None, batch_size=10000):
+    if isinstance(profiles, pd.DataFrame):
+        profiles = RaggedProfiles.from_frame(profiles)
+    if isinstance(profiles, RaggedProfiles):
+        ids = profiles.id
+        sources = profiles.source if source is None else np.full(len(profiles), source, dtype=object)
+    else:
+        profiles = list(profiles)
+        ids = [prof['id'].iloc[0] for prof in profiles]
+        sources = np.full(len(profiles), source, dtype=object)
+    id_type = pa.array(ids).type
+    schema = getSQI_arrow_schema(pa.string() if id_type == pa.null() else id_type)
+    requirements = getGAEZ_requirements(CROP_ID, inputLevel)
+    dictionaries = {'Input Level': pa.array([inputLevel], type=pa.string()),
+                    'data_source': pa.array([s for s in pd.unique(pd.Series(sources, dtype=object)) if not pd.isnull(s)], type=pa.string())}
+
+    columns = {c: [] for c in schema.names}
+    n_batches = 0
+    for i, prof in enumerate(profiles):
+        try:
+            scores = getGAEZ_SQI_scores(prof, CROP_ID, inputLevel, depthWt_type, requirements)
+        except Exception as err:
+            print('ERROR : ' + str(ids[i]) + ' ' + str(err))
+            continue
+        if isinstance(scores, str):
+            print('ERROR : ' + str(ids[i]) + ' ' + scores)
+            continue
+        columns['id'].append(ids[i])
+        for c, score in zip(SQI_columns, scores):
+            columns[c].append(_score_or_null(score))
+        columns['Input Level'].append(inputLevel)
+        columns['data_source'].append(sources[i])
+        if len(columns['id']) == batch_size:
+            yield _SQI_record_batch(columns, schema, dictionaries)
+            n_batches = n_batches + 1
+            columns = {c: [] for c in schema.names}
+    # always yield at least one (possibly empty) batch so that the schema reaches the caller
+    if len(columns['id']) > 0 or n_batches == 0:
+        yield _SQI_record_batch(columns, schema, dictionaries)
+
+# Batched func_prof_comp_GAEZ_SQI. Returns a pyarrow Table, or, with `out_path`, streams the batches to an
+# uncompressed Arrow IPC file (memory-mappable from R) and returns the path.
+def func_prof_comp_GAEZ_SQI_batch(profiles, CROP_ID, inputLevel, depthWt_type=1, source=None, out_path=None, batch_size=10000):
+    batches = iter_GAEZ_SQI_batches(profiles, CROP_ID, inputLevel, depthWt_type, source, batch_size)
+    if out_path is None:
+        batches = list(batches)
+        return pa.Table.from_batches(batches)
+    writer = None
+    try:
+        for batch in batches:
+            if writer is None:
+                writer = pa.ipc.new_file(out_path, batch.schema)
+            writer.write_batch(batch)
+    finally:
+        if writer is not None:
+            writer.close()
+    return out_path
+
+#####################################################################################################
+#                                  suitability map tile pyramid                                     #
+#####################################################################################################
+# Export of an SR raster for map serving: the ratings are classified into the S0...N suitability classes
+# (getSR_class_id), written as a Cloud-Optimized GeoTIFF with internal overviews, and cut into an XYZ
+# (Web Mercator) tile cache of palette PNGs at tile_dir/z/x/y.png. Class rasters are categorical, so every
+# overview and lower zoom level uses mode (majority) resampling instead of averaging. After part of the map
+# has been rescored only the tiles touching that region are regenerated.
+
+# RGBA colour of each class raster value: 0 = no data (transparent), then N, S4, S3, S2, S1, S0
+SR_class_colours = [(0, 0, 0, 0), (200, 30, 30, 255), (240, 120, 40, 255), (250, 200, 60, 255),
+                    (200, 230, 110, 255), (110, 190, 80, 255), (30, 130, 60, 255)]
+
+WEB_MERCATOR_HALF = 20037508.342789244
+
+def _SR_colour_table():
+    ct = gdal.ColorTable()
+    for i, c in enumerate(SR_class_colours):
+        ct.SetColorEntry(i, c)
+    return ct
+
+# Classify an SR raster into a Byte raster of class ids + 1 (1 = N ... 6 = S0, 0 = no data), block by block
+def getSR_class_raster(sr_path, out_path, block_rows=1024):
+    src = gdal.Open(sr_path)
+    src_band = src.GetRasterBand(1)
+    nodata = src_band.GetNoDataValue()
+    dst = gdal.GetDriverByName('GTiff').Create(out_path, src.RasterXSize, src.RasterYSize, 1, gdal.GDT_Byte, options=['COMPRESS=DEFLATE', 'TILED=YES'])
+    dst.SetGeoTransform(src.GetGeoTransform())
+    dst.SetProjection(src.GetProjection())
+    dst_band = dst.GetRasterBand(1)
+    dst_band.SetNoDataValue(0)
+    dst_band.SetColorTable(_SR_colour_table())
+    for r0 in range(0, src.RasterYSize, block_rows):
+        rows = min(block_rows, src.RasterYSize - r0)
+        sr = src_band.ReadAsArray(0, r0, src.RasterXSize, rows).astype(float)
+        if nodata is not None:
+            sr[sr == nodata] = np.nan
+        dst_band.WriteArray((getSR_class_id(sr) + 1).astype(np.uint8), 0, r0)
+    dst.FlushCache()
+    dst = None
+    return out_path
+
+# Cloud-Optimized GeoTIFF of a class raster with internal mode-resampled overviews
+def export_SR_COG(class_path, cog_path):
+    if gdal.GetDriverByName('COG') is not None:
+        # the overview resampling option is RESAMPLING in GDAL 3.1 and OVERVIEW_RESAMPLING from 3.2 on, where
+        # it takes precedence; a version that does not know one of them ignores it with a warning
+        gdal.Translate(cog_path, class_path, format='COG',
+                       creationOptions=['COMPRESS=DEFLATE', 'RESAMPLING=MODE', 'OVERVIEW_RESAMPLING=MODE', 'BLOCKSIZE=512'])
+    else:
+        # GDAL < 3.1 has no COG driver: build the overviews on a copy and copy them in front of the data
+        tmp_path = cog_path + '.tmp.tif'
+        gdal.Translate(tmp_path, class_path, format='GTiff')
+        tmp = gdal.Open(tmp_path, gdal.GA_Update)
+        tmp.BuildOverviews('MODE', [2, 4, 8, 16, 32, 64])
+        tmp = None
+        gdal.Translate(cog_path, tmp_path, format='GTiff', creationOptions=['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512', 'COPY_SRC_OVERVIEWS=YES', 'COMPRESS=DEFLATE'])
+        os.remove(tmp_path)
+    return cog_path
+
+# Extent of a raster in lon/lat
+def _raster_lonlat_bounds(ds):
+    gt = ds.GetGeoTransform()
+    xs = [gt[0], gt[0] + gt[1] * ds.RasterXSize]
+    ys = [gt[3], gt[3] + gt[5] * ds.RasterYSize]
+    src_srs = osr.SpatialReference(wkt=ds.GetProjection())
+    dst_srs = osr.SpatialReference()
+    dst_srs.ImportFromEPSG(4326)
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        src_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        dst_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    tr = osr.CoordinateTransformation(src_srs, dst_srs)
+    pts = np.array([tr.TransformPoint(x, y)[:2] for x in xs for y in ys])
+    return pts[:, 0].min(), pts[:, 1].min(), pts[:, 0].max(), pts[:, 1].max()
+
+# XYZ tiles (x0, x1, y0, y1, inclusive) covering lon/lat bounds at zoom z
+def _tile_range(bounds, z):
+    n = 2 ** z
+    lon0, lat0, lon1, lat1 = bounds
+    def tile_x(lon):
+        return int(np.clip(np.floor((lon + 180) / 360 * n), 0, n - 1))
+    def tile_y(lat):
+        lat = np.radians(np.clip(lat, -85.0511, 85.0511))
+        return int(np.clip(np.floor((1 - np.arcsinh(np.tan(lat)) / np.pi) / 2 * n), 0, n - 1))
+    return tile_x(lon0), tile_x(lon1), tile_y(lat1), tile_y(lat0)
+
+# Web Mercator bounds (minx, miny, maxx, maxy) of an XYZ tile
+def _tile_bounds(x, y, z):
+    size = 2 * WEB_MERCATOR_HALF / 2 ** z
+    return (-WEB_MERCATOR_HALF + x * size, WEB_MERCATOR_HALF - (y + 1) * size, -WEB_MERCATOR_HALF + (x + 1) * size, WEB_MERCATOR_HALF - y * size)
+
+def _tile_path(tile_dir, z, x, y):
+    return os.path.join(tile_dir, str(z), str(x), str(y) + '.png')
+
+def _read_tile(tile_dir, z, x, y):
+    path = _tile_path(tile_dir, z, x, y)
+    if not os.path.exists(path):
+        return None
+    return gdal.Open(path).ReadAsArray()
+
+# Write a palette PNG tile (replacing the old one atomically, so tiles can be served while updating);
+# tiles without data are removed
+def _write_tile(tile_dir, z, x, y, tile, colour_table):
+    path = _tile_path(tile_dir, z, x, y)
+    if not tile.any():
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    mem = gdal.GetDriverByName('MEM').Create('', tile.shape[1], tile.shape[0], 1, gdal.GDT_Byte)
+    band = mem.GetRasterBand(1)
+    band.WriteArray(tile)
+    band.SetColorTable(colour_table)
+    gdal.GetDriverByName('PNG').CreateCopy(path + '.tmp', mem)
+    os.replace(path + '.tmp', path)
+
+# Halve a class mosaic by taking the most frequent class of every 2 x 2 block, ignoring no data (0).
+# Ties go to the lowest class id, i.e. the more constrained class.
+def _mode_downsample(mosaic, n_class=len(SR_class_labels)):
+    h, w = mosaic.shape[0] // 2, mosaic.shape[1] // 2
+    blocks = mosaic.reshape(h, 2, w, 2).transpose(0, 2, 1, 3).reshape(h, w, 4)
+    counts = np.stack([(blocks == c).sum(axis=-1) for c in range(1, n_class + 1)], axis=-1)
+    out = (counts.argmax(axis=-1) + 1).astype(np.uint8)
+    out[counts.max(axis=-1) == 0] = 0
+    return out
+
+# Build or update the XYZ tile cache of a class raster. Tiles at max_zoom are warped from the class raster
+# with mode resampling; every lower zoom is made from its four child tiles already on disk. With `bounds`
+# (lon/lat of a rescored region) only the tiles touching that region are regenerated.
+def build_SR_tiles(class_path, tile_dir, min_zoom=0, max_zoom=10, bounds=None, tile_size=256):
+    src = gdal.Open(class_path)
+    raster_bounds = _raster_lonlat_bounds(src)
+    if bounds is None:
+        bounds = raster_bounds
+    else:
+        bounds = (max(bounds[0], raster_bounds[0]), max(bounds[1], raster_bounds[1]), min(bounds[2], raster_bounds[2]), min(bounds[3], raster_bounds[3]))
+        if bounds[0] > bounds[2] or bounds[1] > bounds[3]:
+            return tile_dir
+    colour_table = _SR_colour_table()
+
+    x0, x1, y0, y1 = _tile_range(bounds, max_zoom)
+    for x in range(x0, x1 + 1):
+        for y in range(y0, y1 + 1):
+            tile = gdal.Warp('', src, format='MEM', outputBounds=_tile_bounds(x, y, max_zoom), width=tile_size, height=tile_size,
+                             dstSRS='EPSG:3857', resampleAlg='mode', srcNodata=0, dstNodata=0)
+            _write_tile(tile_dir, max_zoom, x, y, tile.ReadAsArray(), colour_table)
+
+    for z in range(max_zoom - 1, min_zoom - 1, -1):
+        x0, x1, y0, y1 = _tile_range(bounds, z)
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                mosaic = np.zeros((2 * tile_size, 2 * tile_size), dtype=np.uint8)
+                for dx in range(2):
+                    for dy in range(2):
+                        child = _read_tile(tile_dir, z + 1, 2 * x + dx, 2 * y + dy)
+                        if child is not None:
+                            mosaic[dy * tile_size:(dy + 1) * tile_size, dx * tile_size:(dx + 1) * tile_size] = child
+                _write_tile(tile_dir, z, x, y, _mode_downsample(mosaic), colour_table)
+    return tile_dir
 
+# Full export of an SR raster: class raster, COG and tile cache in out_dir. After rescoring part of the map,
+# call again with the lon/lat `bounds` of the rescored region to refresh only the tiles it touches.
+def export_SR_map(sr_path, out_dir, min_zoom=0, max_zoom=10, bounds=None):
+    os.makedirs(out_dir, exist_ok=True)
+    class_path = getSR_class_raster(sr_path, os.path.join(out_dir, 'SR_class.tif'))
+    export_SR_COG(class_path, os.path.join(out_dir, 'SR_class_cog.tif'))
+    build_SR_tiles(class_path, os.path.join(out_dir, 'tiles'), min_zoom, max_zoom, bounds)
+    return out_dir